@@ -1,10 +1,23 @@
-from flask import Flask, render_template, redirect, url_for, request, flash, send_file
+from flask import Flask, render_template, redirect, url_for, request, flash, abort, jsonify, make_response, session, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import exists, insert, update
+from sqlalchemy.orm import load_only
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 import cloudinary
 import cloudinary.uploader
-import io, zipfile, requests
+import cloudinary.api
+import cloudinary.utils
+from cloudinary.exceptions import RateLimited
+import hashlib, os, shutil, tempfile, time, zipfile, requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
 from config import Config
 
 # ----------------- App Setup -----------------
@@ -21,6 +34,27 @@ cloudinary.config(
     api_secret=app.config['CLOUDINARY_API_SECRET']
 )
 
+# Argon2id for passwords; cheaper per login than werkzeug's default PBKDF2 rounds
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
+# Shared HTTP session for all outbound requests: pooled keep-alive connections,
+# retried with backoff on throttling and transient upstream errors
+http = requests.Session()
+http.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=max(64, app.config['DOWNLOAD_CONCURRENCY'] * 2),
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+))
+
+# Changes with every deploy (Render's commit, else newest code/template mtime), so
+# pages cached against an ETag are re-rendered after the code or templates change
+BUILD_TOKEN = os.environ.get('RENDER_GIT_COMMIT') or str(max(
+    os.path.getmtime(path) for path in [
+        __file__,
+        *(entry.path for entry in os.scandir(os.path.join(app.root_path, app.template_folder)))
+    ]
+))
+
 # ----------------- Models -----------------
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -32,16 +66,112 @@ class Media(db.Model):
     filename = db.Column(db.String(300), nullable=False)
     url = db.Column(db.String(500), nullable=False)
     public_id = db.Column(db.String(500), nullable=False)
-    is_visible = db.Column(db.Boolean, default=True)
+    is_visible = db.Column(db.Boolean, default=True, index=True)
     uploaded_by = db.Column(db.String(150), nullable=True)
     description = db.Column(db.String(500), nullable=True)  # metadata field
     size = db.Column(db.Integer, nullable=True)
     mimetype = db.Column(db.String(50), nullable=True)
 
+# Columns the gallery/manage cards actually render
+CARD_COLUMNS = (Media.id, Media.filename, Media.url, Media.public_id, Media.uploaded_by, Media.description)
+
 # ----------------- User Loader -----------------
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Flask-Login already caches the result on g for the rest of the request
+    return db.session.get(User, int(user_id))
+
+# ----------------- Helpers -----------------
+class ZipStream:
+    """Write-only sink for ZipFile; drain() hands back whatever was written since the last call."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def zip_compression(mimetype):
+    """Per-entry compression for zip downloads.
+
+    Media is stored by default: images, video and archives are already compressed,
+    so the archive step is a plain copy. Only text-like payloads are deflated.
+    """
+    mimetype = mimetype or ''
+    if mimetype.startswith('text/') or mimetype == 'application/json':
+        return zipfile.ZIP_DEFLATED
+    return zipfile.ZIP_STORED
+
+def cloudinary_resource_type(mimetype):
+    """Cloudinary keeps audio and video under 'video'; everything else was stored as 'image'
+    unless Cloudinary itself filed it as 'raw' (see cloudinary_mimetype)."""
+    mimetype = mimetype or ''
+    if mimetype.startswith(('video/', 'audio/')):
+        return 'video'
+    if mimetype.startswith('raw/'):
+        return 'raw'
+    return 'image'
+
+def cloudinary_mimetype(result):
+    """Best-effort mimetype from an upload result, for when the browser sent none."""
+    if result.get('resource_type') and result.get('format'):
+        return f"{result['resource_type']}/{result['format']}"
+    return None
+
+def delete_cloudinary_resources(public_ids, resource_type='image', retries=4):
+    """Delete via the batch Admin API (100 ids per call), backing off when rate limited."""
+    for start in range(0, len(public_ids), 100):
+        chunk = public_ids[start:start + 100]
+        for attempt in range(retries + 1):
+            try:
+                cloudinary.api.delete_resources(chunk, resource_type=resource_type)
+                break
+            except RateLimited:
+                if attempt == retries:
+                    raise
+                time.sleep(0.5 * 2 ** attempt)
+
+@app.template_global()
+def thumbnail_url(media):
+    """400px-wide, auto quality/format rendition of an image instead of the full-size original."""
+    return cloudinary.CloudinaryImage(media.public_id).build_url(
+        width=400, crop='fill', quality='auto', fetch_format='auto', secure=True
+    )
+
+def keyset_page(query):
+    """Newest-first page of media older than ?before=<id>; returns (items, next cursor or None)."""
+    per_page = app.config['MEDIA_PER_PAGE']
+    before = request.args.get('before', type=int)
+    if before:
+        query = query.filter(Media.id < before)
+    items = query.order_by(Media.id.desc()).limit(per_page + 1).all()
+    next_before = items[per_page - 1].id if len(items) > per_page else None
+    return items[:per_page], next_before
+
+def verify_password(user, password):
+    """Check a login attempt, upgrading legacy werkzeug hashes to argon2 on success."""
+    if user.password.startswith('$argon2'):
+        try:
+            password_hasher.verify(user.password, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        if not password_hasher.check_needs_rehash(user.password):
+            return True
+    elif not check_password_hash(user.password, password):
+        return False
+
+    user.password = password_hasher.hash(password)
+    db.session.commit()
+    return True
 
 # ----------------- Auth Routes -----------------
 
@@ -55,11 +185,11 @@ def register():
             flash("Username and password cannot be empty.")
             return redirect(url_for('register'))
 
-        if User.query.filter_by(username=username).first():
+        if db.session.query(exists().where(User.username == username)).scalar():
             flash("That username is already taken.")
             return redirect(url_for('register'))
 
-        hashed = generate_password_hash(password)
+        hashed = password_hasher.hash(password)
         new_user = User(username=username, password=hashed)
         db.session.add(new_user)
         db.session.commit()
@@ -70,14 +200,14 @@ def register():
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
-    if not User.query.first():
+    if not db.session.query(User.query.exists()).scalar():
         return redirect(url_for('setup'))
 
     if request.method == 'POST':
         username = request.form.get('username')
         password = request.form.get('password')
         user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password, password):
+        if user and verify_password(user, password):
             login_user(user)
             return redirect(url_for('manage'))
         flash("Invalid credentials")
@@ -107,32 +237,39 @@ def upload():
         uploader_name = current_user.username if current_user.is_authenticated else request.form.get('uploader_name', 'Anonymous')
         description = request.form.get('description')
 
+        large = (request.content_length or 0) > app.config['LARGE_UPLOAD_THRESHOLD']
+        rows = []
         for file in files:
             if file and file.filename:
-                # Reset pointer for size calculation
-                file.seek(0)
-                size = len(file.read())
-                file.seek(0)
-
                 try:
-                    # Upload to Cloudinary
-                    result = cloudinary.uploader.upload(file, resource_type="auto")
-
-                    media = Media(
+                    # Upload to Cloudinary, in resumable chunks for big requests
+                    if large:
+                        # Pass the underlying stream (FileStorage isn't a context manager) and the
+                        # real name, otherwise upload_large names the asset after the form field
+                        result = cloudinary.uploader.upload_large(
+                            file.stream, filename=file.filename, resource_type="auto",
+                            chunk_size=app.config['LARGE_UPLOAD_CHUNK_SIZE']
+                        )
+                    else:
+                        result = cloudinary.uploader.upload(file, resource_type="auto")
+
+                    rows.append(dict(
                         filename=file.filename,
                         url=result['secure_url'],
                         public_id=result['public_id'],
                         uploaded_by=uploader_name,
                         description=description,
-                        size=size,
-                        mimetype=file.mimetype
-                    )
-                    db.session.add(media)
+                        size=result.get('bytes'),  # what Cloudinary actually stored
+                        mimetype=file.mimetype or cloudinary_mimetype(result)
+                    ))
 
                 except Exception as e:
                     flash(f"Upload failed for {file.filename}: {str(e)}")
                     continue
 
+        # One multi-row INSERT for the whole batch
+        if rows:
+            db.session.execute(insert(Media), rows)
         db.session.commit()
         flash("Upload successful!")
         return redirect(url_for('gallery'))
@@ -140,27 +277,118 @@ def upload():
     return render_template('upload.html')
 
 
+@app.route('/upload/sign', methods=['POST'])
+def upload_sign():
+    """Sign a direct browser-to-Cloudinary upload so file bytes never pass through this worker."""
+    timestamp = int(time.time())
+    signature = cloudinary.utils.api_sign_request({'timestamp': timestamp}, app.config['CLOUDINARY_API_SECRET'])
+    return jsonify({
+        'cloud_name': app.config['CLOUDINARY_CLOUD_NAME'],
+        'api_key': app.config['CLOUDINARY_API_KEY'],
+        'timestamp': timestamp,
+        'signature': signature
+    })
+
+
+@app.route('/upload/complete', methods=['POST'])
+def upload_complete():
+    """Record files the browser already uploaded to Cloudinary."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('files', []), list) \
+            or not isinstance(data.get('failed', []), list):
+        abort(400)
+    uploader_name = current_user.username if current_user.is_authenticated else str(data.get('uploader_name', 'Anonymous'))[:150]
+    description = str(data['description'])[:500] if data.get('description') else None
+
+    items = [item for item in data.get('files', []) if isinstance(item, dict)]
+    # Uploads that were already recorded (e.g. a retried request) are skipped
+    known = {public_id for (public_id,) in db.session.query(Media.public_id).filter(
+        Media.public_id.in_([str(item.get('public_id')) for item in items])
+    )}
+
+    rows = []
+    for item in items:
+        public_id, version = item.get('public_id'), item.get('version')
+        filename = str(item.get('filename') or public_id)
+        # Only trust results Cloudinary actually signed; that covers public_id and version only
+        if not isinstance(public_id, str) or not cloudinary.utils.verify_api_response_signature(public_id, version, item.get('signature')):
+            flash(f"Upload failed for {filename}: invalid signature")
+            continue
+        if public_id in known:
+            continue
+        known.add(public_id)
+
+        # Everything else is client-supplied, so the delivery URL is rebuilt here
+        resource_type = item.get('resource_type')
+        if resource_type not in ('image', 'video', 'raw'):
+            flash(f"Upload failed for {filename}: unknown resource type")
+            continue
+        fmt = item.get('format')
+        fmt = fmt if isinstance(fmt, str) and fmt.isalnum() else None
+        url, _ = cloudinary.utils.cloudinary_url(
+            public_id, resource_type=resource_type, version=version, format=fmt, secure=True
+        )
+
+        # Browsers often send no type (or octet-stream) for video containers; fall back to
+        # Cloudinary's classification so deletes later target the right resource type
+        mimetype = str(item.get('mimetype') or '')[:50] or None
+        if cloudinary_resource_type(mimetype) != resource_type:
+            mimetype = f"{resource_type}/{fmt or 'octet-stream'}"
+        size = item.get('bytes')
+
+        rows.append(dict(
+            filename=filename[:300],
+            url=url,
+            public_id=public_id,
+            uploaded_by=uploader_name,
+            description=description,
+            size=size if isinstance(size, int) else None,
+            mimetype=mimetype
+        ))
+
+    for filename in data.get('failed', []):
+        flash(f"Upload failed for {filename}")
+
+    if rows:
+        db.session.execute(insert(Media), rows)
+    db.session.commit()
+    flash("Upload successful!")
+    return jsonify({'redirect': url_for('gallery')})
+
 
 
 
 @app.route('/gallery')
 def gallery():
-    medias = Media.query.filter_by(is_visible=True).all()
-    return render_template('gallery.html', medias=medias)
+    medias, next_before = keyset_page(Media.query.options(load_only(*CARD_COLUMNS)).filter_by(is_visible=True))
+
+    # Rows are only ever hidden or deleted, so the page's ids (plus the nav's login
+    # state and the build) identify its content; browsers revalidate and get a 304 when unchanged.
+    page_key = ','.join(str(media.id) for media in medias)
+    viewer = current_user.get_id() if current_user.is_authenticated else ''
+    etag = hashlib.md5(f'{BUILD_TOKEN}:{page_key}:{next_before}:{viewer}'.encode()).hexdigest()
+
+    # Pending flash messages are rendered by base.html, so never skip the render then
+    if '_flashes' not in session and request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        resp = make_response(render_template('gallery.html', medias=medias, next_before=next_before))
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
 
-from flask import request, jsonify
 
 @app.route('/manage')
 @login_required
 def manage():
-    medias = Media.query.all()
-    return render_template('manage.html', medias=medias)
+    medias, next_before = keyset_page(Media.query.options(load_only(*CARD_COLUMNS)))
+    return render_template('manage.html', medias=medias, next_before=next_before)
 
 
 @app.route('/delete/<int:media_id>')
 @login_required
 def delete(media_id):
-    media = Media.query.get(media_id)
+    media = db.session.get(Media, media_id)
     if media:
         cloudinary.uploader.destroy(media.public_id)
         db.session.delete(media)
@@ -172,7 +400,7 @@ def delete(media_id):
 @app.route('/toggle_visibility/<int:media_id>')
 @login_required
 def toggle_visibility(media_id):
-    media = Media.query.get(media_id)
+    media = db.session.get(Media, media_id)
     if media:
         media.is_visible = not media.is_visible
         db.session.commit()
@@ -187,19 +415,62 @@ def download_selected():
         flash("No files selected")
         return redirect(url_for('manage'))
 
-    memory_file = io.BytesIO()
-    with zipfile.ZipFile(memory_file, 'w') as zf:
-        for media_id in selected_ids:
-            media = Media.query.get(int(media_id))
-            if media:
-                response = requests.get(media.url)
-                zf.writestr(media.filename, response.content)
-
-    memory_file.seek(0)
-    return send_file(
-        memory_file,
-        download_name='selected_media.zip',
-        as_attachment=True
+    medias = Media.query.filter(Media.id.in_([int(m_id) for m_id in selected_ids])).all()
+    entries = [(media.filename, media.url, media.mimetype) for media in medias]
+
+    def fetch(entry):
+        filename, url, mimetype = entry
+        # Stream the body in 64 KB chunks; spools to disk past 1 MB instead of holding it in RAM
+        spool = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        try:
+            with http.get(url, timeout=(5, 30), stream=True) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                shutil.copyfileobj(response.raw, spool, length=65536)
+        except (requests.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+            # The response is already streaming, so one bad file can't abort the archive
+            app.logger.warning("Skipping %s in zip download: %s", filename, e)
+            spool.close()
+            return filename, None
+        spool.seek(0)
+        info = zipfile.ZipInfo(filename, date_time=time.localtime()[:6])
+        info.compress_type = zip_compression(mimetype)
+        return info, spool
+
+    concurrency = app.config['DOWNLOAD_CONCURRENCY']
+
+    def generate():
+        # ZipFile falls back to data descriptors on an unseekable sink, so each
+        # chunk can go out to the client as soon as it is written.
+        stream = ZipStream()
+        with zipfile.ZipFile(stream, 'w', allowZip64=True) as zf, \
+                ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # Fetch in parallel, but write to the zip on this thread (ZipFile isn't thread-safe).
+            # Only `concurrency` fetches are in flight at once, refilled as entries are taken,
+            # so downloads can't run ahead of the client and pile up in spools.
+            pending = iter(entries)
+            in_flight = deque(executor.submit(fetch, entry) for entry in islice(pending, concurrency))
+            failed = []
+            while in_flight:
+                info, spool = in_flight.popleft().result()
+                for entry in islice(pending, 1):
+                    in_flight.append(executor.submit(fetch, entry))
+                if spool is None:
+                    failed.append(info)
+                    continue
+                with spool, zf.open(info, 'w', force_zip64=True) as dest:
+                    for chunk in iter(lambda: spool.read(65536), b''):
+                        dest.write(chunk)
+                        yield stream.drain()
+                yield stream.drain()
+            if failed:
+                zf.writestr('download_errors.txt', 'Could not download:\n' + '\n'.join(failed) + '\n')
+        yield stream.drain()
+
+    return Response(
+        stream_with_context(chunk for chunk in generate() if chunk),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename=selected_media.zip'}
     )
 
 
@@ -209,26 +480,29 @@ def download_selected():
 @login_required
 def bulk_toggle_visibility():
     data = request.get_json()
-    media_ids = data.get('media_ids', [])
-    for m_id in media_ids:
-        media = Media.query.get(m_id)
-        if media:
-            media.is_visible = not media.is_visible
-            db.session.add(media)
+    media_ids = [int(m_id) for m_id in data.get('media_ids', [])]
+    # Flip every row in a single UPDATE instead of a SELECT + UPDATE per id
+    result = db.session.execute(
+        update(Media)
+        .where(Media.id.in_(media_ids))
+        .values(is_visible=~Media.is_visible)
+        .execution_options(synchronize_session=False)
+    )
     db.session.commit()
-    return jsonify({'status': 'success'})
+    return jsonify({'status': 'success', 'updated': result.rowcount})
 
 
 @app.route('/bulk_delete', methods=['POST'])
 @login_required
 def bulk_delete():
     data = request.get_json()
-    media_ids = data.get('media_ids', [])
-    for m_id in media_ids:
-        media = Media.query.get(m_id)
-        if media:
-            cloudinary.uploader.destroy(media.public_id)
-            db.session.delete(media)
+    media_ids = [int(m_id) for m_id in data.get('media_ids', [])]
+    public_ids = {}
+    for media in Media.query.filter(Media.id.in_(media_ids)).all():
+        public_ids.setdefault(cloudinary_resource_type(media.mimetype), []).append(media.public_id)
+    for resource_type, ids in public_ids.items():
+        delete_cloudinary_resources(ids, resource_type)
+    Media.query.filter(Media.id.in_(media_ids)).delete(synchronize_session=False)
     db.session.commit()
     return jsonify({'status': 'success'})
 
@@ -238,4 +512,5 @@ def bulk_delete():
  #       db.create_all()
  #   app.run(debug=True)
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    # Local development only; production runs under gunicorn (see gunicorn.conf.py)
+    app.run(host="0.0.0.0", port=5000, debug=os.environ.get('FLASK_DEBUG') == '1')
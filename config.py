@@ -8,8 +8,25 @@ class Config:
     # PostgreSQL (Render)
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Per gunicorn worker; pre_ping/recycle replace connections Render's proxy has dropped
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+    }
 
     # Cloudinary
     CLOUDINARY_CLOUD_NAME = os.environ.get('CLOUDINARY_CLOUD_NAME')
     CLOUDINARY_API_KEY = os.environ.get('CLOUDINARY_API_KEY')
     CLOUDINARY_API_SECRET = os.environ.get('CLOUDINARY_API_SECRET')
+
+    # Gallery / manage page size
+    MEDIA_PER_PAGE = int(os.environ.get('MEDIA_PER_PAGE', 48))
+
+    # Concurrent outbound fetches per request (zip downloads)
+    DOWNLOAD_CONCURRENCY = int(os.environ.get('DOWNLOAD_CONCURRENCY', 8))
+
+    # Form uploads bigger than this go through Cloudinary's chunked upload_large
+    LARGE_UPLOAD_THRESHOLD = int(os.environ.get('LARGE_UPLOAD_THRESHOLD', 20 * 1000 * 1000))
+    LARGE_UPLOAD_CHUNK_SIZE = int(os.environ.get('LARGE_UPLOAD_CHUNK_SIZE', 6 * 1024 * 1024))
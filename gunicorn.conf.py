@@ -0,0 +1,11 @@
+import os
+
+# Threaded workers so slow Cloudinary/HTTP calls don't block other requests.
+# Kept small by default: each worker carries its own DB pool and argon2 memory,
+# and cpu_count() reports the host, not the container's quota.
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Uploads and zip downloads can run long
+timeout = 120